@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""Microbenchmark of GCM request bodies serialization, in bytes/s and
+batches/s:
+ - stdlib: every batch encoded by json.dumps, like push_one used to.
+ - full: every batch encoded by gcm_pusher.dumps, orjson if available.
+ - spliced: the part shared by all batches encoded once per message
+   and spliced in each batch, kept to show it doesn't pay.
+"""
+
+import json
+from argparse import ArgumentParser
+from timeit import timeit
+from gcm_pusher import dumps, GCM_MAX_REGISTRATION_IDS
+
+
+def request(message, registration_ids):
+    data = {'registration_ids': registration_ids,
+            'data': {'msg': message['message']}}
+    if message['collapse_key'] is not None:
+        data['collapse_key'] = message['collapse_key']
+    data['delay_while_idle'] = bool(message['delay_while_idle'])
+    return data
+
+
+def stdlib(message, batches):
+    size = 0
+    for registration_ids in batches:
+        size += len(json.dumps(request(message, registration_ids)).encode())
+    return size
+
+
+def full(message, batches):
+    size = 0
+    for registration_ids in batches:
+        size += len(dumps(request(message, registration_ids)))
+    return size
+
+
+def spliced(message, batches):
+    size = 0
+    payload = dumps({'data': {'msg': message['message']},
+                     'collapse_key': message['collapse_key'],
+                     'delay_while_idle': bool(message['delay_while_idle'])})
+    payload = memoryview(payload)[1:]
+    for registration_ids in batches:
+        size += len(b''.join((b'{"registration_ids":', dumps(registration_ids),
+                              b',', payload)))
+    return size
+
+
+def parse_args():
+    """Parse command line arguments.
+    """
+    parser = ArgumentParser(
+        description='Benchmark GCM request bodies serialization.')
+    parser.add_argument('--batches', default=10, type=int,
+                        help='Number of batches of registration_ids')
+    parser.add_argument('--message-size', default=4096, type=int,
+                        help='Size of the message, in characters')
+    parser.add_argument('--number', default=100, type=int,
+                        help='Number of times to serialize all batches')
+    return parser.parse_args()
+
+
+def main(batches, message_size, number):
+    message = {'message': 'é' * message_size,
+               'collapse_key': 'bench',
+               'delay_while_idle': 1}
+    batches = [['APA91b' + '%0146d' % (i * GCM_MAX_REGISTRATION_IDS + j)
+                for j in range(GCM_MAX_REGISTRATION_IDS)]
+               for i in range(batches)]
+    for encode in stdlib, full, spliced:
+        size = encode(message, batches) * number
+        duration = timeit(lambda: encode(message, batches), number=number)
+        print("{:8}: {:8.1f} MB/s, {:8.0f} batches/s".format(
+            encode.__name__, size / duration / 1e6,
+            len(batches) * number / duration))
+
+if __name__ == '__main__':
+    main(**vars(parse_args()))
@@ -22,6 +22,10 @@ The sender may be multithreade following this model:
 
 """
 
+# Messages are sent in priority lanes, from bulk (0) to urgent (9).
+PRIORITY_MIN = 0
+PRIORITY_MAX = 9
+
 
 class MySQLBackend():
     def __init__(self, host, user, password, db):
@@ -204,15 +208,15 @@ class GCMBackendMessage():
         self.gcm = gcm
 
     def add(self, message, to_channel, collapse_key=None,
-            delay_while_idle=True):
+            delay_while_idle=True, priority=PRIORITY_MIN):
         _, channel_id = self.gcm.channel.create(to_channel)
         _, message_id = self.gcm.db.execute(
             """INSERT INTO message (message, retry_after,
                       collapse_key, delay_while_idle, channel_id,
-                      ctime)
-               VALUES (%s, NOW(), %s, %s, %s, NOW())""",
+                      priority, ctime)
+               VALUES (%s, NOW(), %s, %s, %s, %s, NOW())""",
             (message, collapse_key,
-             1 if delay_while_idle else 0, channel_id))
+             1 if delay_while_idle else 0, channel_id, priority))
         qte, recipients = self.gcm.user.get(channel=to_channel)
         for recipient in recipients:
             self.gcm.db.execute(
@@ -227,6 +231,9 @@ class GCMBackendMessage():
               message.message,
               message.collapse_key,
               message.delay_while_idle,
+              message.channel_id,
+              message.priority,
+              UNIX_TIMESTAMP(message.ctime) AS ctime,
               GROUP_CONCAT(user.registration_id SEPARATOR 0x1D)
                 AS registration_ids
          FROM message
@@ -235,7 +242,8 @@ class GCMBackendMessage():
         WHERE message.status = "todo"
               AND retry_after < NOW()
               AND user.valid = 1
-     GROUP BY message.message_id""")
+     GROUP BY message.message_id
+     ORDER BY message.priority DESC, message.message_id""")
         for each in todo:
             each['registration_ids'] = each['registration_ids'].split('\x1D')
         if count > 0:
@@ -3,7 +3,8 @@
 from argparse import ArgumentParser
 import logging
 import json
-from gcm import GCMBackend
+from gcm import GCMBackend, PRIORITY_MIN, PRIORITY_MAX
+from profiling import profiler
 import cherrypy
 from cherrypy import HTTPError
 
@@ -13,6 +14,26 @@ def json_datetime_handler(obj):
         return obj.isoformat()
 
 
+def profile_handler():
+    """Time the request handler as a profiler phase, like 'Channel.POST'.
+    """
+    request = cherrypy.request
+    if not profiler.active or request.handler is None:
+        return
+    handler = request.handler
+    name = getattr(getattr(handler, 'callable', None), '__qualname__',
+                   request.path_info)
+
+    def timed_handler(*args, **kwargs):
+        with profiler.phase(name):
+            return handler(*args, **kwargs)
+    request.handler = timed_handler
+
+# Lower priority than json_out, to wrap the handler before it does.
+cherrypy.tools.profile = cherrypy.Tool('before_handler', profile_handler,
+                                       priority=10)
+
+
 @cherrypy.popargs('channel')
 class Channel(object):
     exposed = True
@@ -24,15 +45,22 @@ class Channel(object):
 
     @cherrypy.tools.accept(media='text/plain')
     @cherrypy.tools.json_out()
-    def POST(self, channel):
+    def POST(self, channel, priority=PRIORITY_MIN):
         gcm = cherrypy.thread_data.gcm
         cherrypy.response.headers['Access-Control-Allow-Origin'] = 'http://kisspush.net'
+        try:
+            priority = int(priority)
+        except (TypeError, ValueError):  # A list if given more than once.
+            priority = None
+        if priority is None or not PRIORITY_MIN <= priority <= PRIORITY_MAX:
+            return {'error': 'priority should be an integer between '
+                    '%d and %d.' % (PRIORITY_MIN, PRIORITY_MAX)}
         content_length = min(int(cherrypy.request.headers['Content-Length']),
                              4096)
         rawbody = cherrypy.request.body.read(content_length)
         if len(rawbody) == 0:
             return {'error': 'Empty body.'}
-        return gcm.message.add(rawbody, channel)
+        return gcm.message.add(rawbody, channel, priority=priority)
 
 
 @cherrypy.popargs('channel')
@@ -92,6 +120,26 @@ class User(object):
         return json.dumps(cherrypy.thread_data.gcm.user.add(reg_id))
 
 
+class Profile(object):
+    """Only mounted with --profile-endpoint: behind a reverse proxy on
+    the same host, every request comes from localhost.
+    """
+    exposed = True
+
+    @cherrypy.tools.json_out()
+    def POST(self, duration=30):
+        if cherrypy.request.remote.ip not in ('127.0.0.1', '::1'):
+            raise HTTPError(403, 'Profiling is only allowed from localhost')
+        try:
+            duration = int(duration)
+        except (TypeError, ValueError):
+            duration = None
+        if duration is None or not 1 <= duration <= 300:
+            raise HTTPError(400, 'duration should be an integer between '
+                            '1 and 300 seconds')
+        return {'started': profiler.start(duration)}
+
+
 class KISSPushHTTP(object):
     exposed = True
     user = User()
@@ -115,6 +163,16 @@ def parse_args(print_help=False):
                         action='store_const',
                         const=logging.DEBUG,
                         help='Log debug messages')
+    parser.add_argument('--profile-duration',
+                        default=30, type=int,
+                        help='Seconds to profile for, on SIGUSR2')
+    parser.add_argument('--profile-dir',
+                        default=profiler.directory,
+                        help='Where to write profiles')
+    parser.add_argument('--profile-endpoint',
+                        default=False, action='store_true',
+                        help='Expose POST /profile, to localhost only. '
+                        'Unsafe behind a reverse proxy on the same host.')
     if print_help:
         parser.print_help()
     return parser.parse_args()
@@ -123,14 +181,24 @@ if __name__ == '__main__':
     logging.getLogger('gcm').addHandler(
         logging.StreamHandler())
     logging.getLogger('gcm').setLevel(logging.DEBUG)
+    logging.getLogger('profiling').addHandler(
+        logging.StreamHandler())
+    logging.getLogger('profiling').setLevel(logging.INFO)
 
     def on_new_thread(thread_id):
         cherrypy.thread_data.gcm = GCMBackend()
     args = parse_args()
+    profiler.name = 'gcm_http_api'
+    profiler.directory = args.profile_dir
+    profiler.install_signal(args.profile_duration)
     cherrypy.config.update({'server.socket_port': args.port,
                             'server.socket_host': '0.0.0.0'})
     cherrypy.engine.subscribe('start_thread', on_new_thread)
+    root = KISSPushHTTP()
+    if args.profile_endpoint:
+        root.profile = Profile()
     cherrypy.quickstart(
-        KISSPushHTTP(),
+        root,
         config={'/': {'request.dispatch':
-                          cherrypy.dispatch.MethodDispatcher()}})
+                          cherrypy.dispatch.MethodDispatcher(),
+                      'tools.profile.on': True}})
@@ -6,12 +6,232 @@
 import json
 import requests
 from argparse import ArgumentParser
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import logging
-from time import sleep
+from time import sleep, time
 from gcm import GCMBackend
+from profiling import profiler
 
 logger = logging.getLogger(__name__)
 
+# GCM refuses multicast messages to more than 1000 registration_ids.
+GCM_MAX_REGISTRATION_IDS = 1000
+
+# Batches failing (5xx or network errors) more than this are dropped.
+MAX_FAILURES = 8
+
+try:
+    from orjson import dumps
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+class WeightedFairQueue(object):
+    """Schedules batches of registration_ids across priority lanes and
+    channels, so a big broadcast can't starve small or urgent messages.
+
+    Each priority is a lane of weight priority + 1: while lanes are
+    competing, a lane of priority 9 gets ten batches sent for each
+    batch of a lane of priority 0. Each lane has a virtual time,
+    advanced by 1 / weight each time one of its batches is sent, the
+    lane with the lowest virtual time is served first. A lane waking
+    up starts at the current virtual time, so it is served at once
+    but can't claim the time it spent idle.
+
+    Inside a lane, channels are served round robin, a batch each.
+    """
+
+    def __init__(self, batch_size=GCM_MAX_REGISTRATION_IDS):
+        self.batch_size = batch_size
+        self.vtime = 0
+        self.size = 0
+        self.lanes = {}
+
+    def __len__(self):
+        return self.size
+
+    def batches(self, message):
+        """The queue of batches of the channel of the given message.
+        """
+        lane = self.lanes.get(message['priority'])
+        if lane is None:
+            lane = self.lanes[message['priority']] = {
+                'vtime': self.vtime,
+                'channels': OrderedDict()}
+        return lane['channels'].setdefault(message['channel_id'], deque())
+
+    def put(self, message):
+        """Split the given message in batches and queue them in its lane.
+        """
+        batches = self.batches(message)
+        registration_ids = message['registration_ids']
+        for i in range(0, len(registration_ids), self.batch_size):
+            batch = dict(message)
+            batch['registration_ids'] = registration_ids[i:i + self.batch_size]
+            batches.append(batch)
+            self.size += 1
+
+    def retry(self, batch):
+        """Queue the given batch again, before the newer batches of its
+        channel, so it can't be overtaken by them.
+        """
+        self.batches(batch).appendleft(batch)
+        self.size += 1
+
+    def get(self):
+        """Pop the next batch to send, or None if the queue is empty.
+        """
+        if not self.lanes:
+            return None
+        priority = min(self.lanes,
+                       key=lambda priority: (self.lanes[priority]['vtime'],
+                                             -priority))
+        lane = self.lanes[priority]
+        self.vtime = lane['vtime']
+        lane['vtime'] += 1 / (priority + 1)
+        channel_id, batches = next(iter(lane['channels'].items()))
+        batch = batches.popleft()
+        if batches:
+            lane['channels'].move_to_end(channel_id)
+        else:
+            del lane['channels'][channel_id]
+            if not lane['channels']:
+                del self.lanes[priority]
+        self.size -= 1
+        return batch
+
+
+class LaneMetrics(object):
+    """Delivery latency per priority lane, from the message creation
+    to the GCM response, periodically logged then reset.
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.since = time()
+        self.lanes = {}
+
+    def record(self, priority, latency):
+        lane = self.lanes.setdefault(priority, {'batches': 0,
+                                                'total': 0.0,
+                                                'max': 0.0})
+        lane['batches'] += 1
+        lane['total'] += latency
+        lane['max'] = max(lane['max'], latency)
+
+    def log(self, force=False):
+        """Log and reset collected metrics, if interval seconds elapsed.
+        """
+        if not force and time() - self.since < self.interval:
+            return False
+        for priority, lane in sorted(self.lanes.items()):
+            logger.info("Lane %d: %d batches sent, latency avg %.2fs, "
+                        "max %.2fs", priority, lane['batches'],
+                        lane['total'] / lane['batches'], lane['max'])
+        self.since = time()
+        self.lanes = {}
+        return True
+
+
+class AIMDController(object):
+    """Adapts the number of requests in flight and the request rate to
+    what GCM can take, the TCP way: additive increase while GCM answers
+    fast, multiplicative decrease on 5xx, Retry-After, network errors
+    or answers slower than slow seconds.
+    5xx and network errors also backoff exponentially until the next
+    success, Retry-After is honored as is.
+    Responses to requests sent before the last decrease, or the last
+    failure, were already in flight: they can't decrease again nor
+    compound the backoff, so a single blip counts once.
+    """
+
+    def __init__(self, max_concurrency=16, max_rate=100, slow=2,
+                 max_backoff=600):
+        self.max_concurrency = max_concurrency
+        self.max_rate = max_rate
+        self.slow = slow
+        self.max_backoff = max_backoff
+        self.concurrency = 1
+        self.rate = max_rate / 2
+        self.latency = 0
+        self.failures = 0
+        self.backoff_until = 0
+        self.next_send = 0
+        self.last_decrease = 0
+        self.last_failure = 0
+
+    def delay(self):
+        """Seconds to wait before sending the next request.
+        """
+        now = time()
+        return max(0, self.backoff_until - now, self.next_send - now)
+
+    def sent(self):
+        """To be called each time a request is sent, returns the time it
+        is sent at, to be given back to update.
+        """
+        now = time()
+        self.next_send = max(now, self.next_send) + 1 / self.rate
+        return now
+
+    def increase(self):
+        self.concurrency = min(self.max_concurrency,
+                               self.concurrency + 1 / self.concurrency)
+        self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+    def decrease(self, sent_at):
+        if sent_at < self.last_decrease:
+            return
+        self.last_decrease = time()
+        self.concurrency = max(1, self.concurrency / 2)
+        self.rate = max(1, self.rate / 2)
+
+    def update(self, response, sent_at):
+        """Adapt to the given GCM response, None meaning a network error,
+        to a request sent at sent_at.
+        """
+        latency = 0
+        if response is not None:
+            latency = response.elapsed.total_seconds()
+            self.latency = .8 * self.latency + .2 * latency
+        retry_after = None
+        if response is not None and 'Retry-After' in response.headers:
+            try:
+                retry_after = int(response.headers['Retry-After'])
+            except ValueError:  # Can be an HTTP date, backoff our way.
+                pass
+        stale = sent_at < self.last_failure
+        failed = response is None or response.status_code >= 500
+        if failed:
+            if stale:
+                return
+            self.last_failure = time()
+            self.failures += 1
+            backoff = (retry_after if retry_after is not None else
+                       min(self.max_backoff, 2 ** (self.failures - 1)))
+        else:
+            if not stale:
+                self.failures = 0
+            backoff = retry_after or 0
+        if backoff > 0:
+            self.backoff_until = max(self.backoff_until, time() + backoff)
+            logger.info("Will backoff %d seconds after receiving a %s",
+                        backoff, "network error" if response is None else
+                        "%d response" % response.status_code)
+        if failed or backoff > 0 or latency > self.slow:
+            self.decrease(sent_at)
+        else:
+            self.increase()
+
+    def log(self):
+        logger.info("GCM controller: %d requests in flight max, "
+                    "%.1f requests/s max, latency %.2fs, %d failures, "
+                    "backoff %ds", self.concurrency, self.rate,
+                    self.latency, self.failures,
+                    max(0, self.backoff_until - time()))
+
 
 class GCMPusher(object):
     """Glue between MySQL and GCM:
@@ -20,9 +240,18 @@ class GCMPusher(object):
         Push to GCM
     """
 
-    def __init__(self, gcm_backend, api_key):
-        self.backoff = 0
+    def __init__(self, gcm_backend, api_key, poll_interval=.5,
+                 max_concurrency=16, max_rate=100):
         self.db = gcm_backend
+        self.queue = WeightedFairQueue()
+        self.metrics = LaneMetrics()
+        self.controller = AIMDController(max_concurrency, max_rate)
+        # A hung request would hold its slot forever, and never tell the
+        # controller anything.
+        self.timeout = 5 * self.controller.slow
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.poll_interval = poll_interval
+        self.last_poll = 0
         self.headers = {'Content-Type': 'application/json',
                         'Authorization': 'key=' + api_key}
         self.url = 'https://android.googleapis.com/gcm/send'
@@ -33,33 +262,96 @@ class GCMPusher(object):
         while True:
             try:
                 self.push_all()
-                if self.backoff > 0:
-                    sleep(self.backoff)
             except Exception:
                 logger.exception(
                     "Unhandled exception while pushing messages to GCM")
             finally:
                 sleep(.5)
 
+    def poll(self):
+        """Fetch messages to send from MySQL into the queue.
+        """
+        with profiler.phase('to_send'):
+            messages = self.db.message.to_send()
+        for message in messages:
+            self.queue.put(message)
+        self.last_poll = time()
+
     def push_all(self):
-        """Fetch all messages to send from MySQL, push them one by one to GCM.
+        """Fetch all messages to send from MySQL, push them batch by batch
+        to GCM in the order given by the queue. MySQL is polled again
+        between batches, so messages posted during a big broadcast
+        don't have to wait for it to finish.
+        Requests are sent from a thread pool, as many and as fast as the
+        controller allows, responses are handled from this thread as
+        they come, as the MySQL link can't be shared between threads.
+        Batches failing with a 5xx or a network error are queued again,
+        to be sent after the backoff, up to MAX_FAILURES times.
+        A failure handling a response, or polling, is logged and doesn't
+        stop the loop, so the other batches in flight aren't lost.
         """
-        for message in self.db.message.to_send():
-            self.push_one(message)
+        self.poll()
+        in_flight = {}
+        while len(self.queue) > 0 or in_flight:
+            if time() - self.last_poll > self.poll_interval:
+                try:
+                    self.poll()
+                except Exception:
+                    logger.exception("While polling MySQL")
+                    self.last_poll = time()
+                if self.metrics.log():
+                    self.controller.log()
+            delay = self.controller.delay()
+            while (len(self.queue) > 0 and delay == 0 and
+                   len(in_flight) < int(self.controller.concurrency)):
+                message = self.queue.get()
+                in_flight[self.executor.submit(self.push_one, message)] = (
+                    message, self.controller.sent())
+                delay = self.controller.delay()
+            if not in_flight:
+                sleep(delay)
+                continue
+            done, _ = wait(in_flight,
+                           timeout=min(delay or self.poll_interval,
+                                       self.poll_interval),
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                message, sent_at = in_flight.pop(future)
+                try:
+                    response = future.result()
+                except Exception:
+                    logger.exception("While sending message %d to GCM",
+                                     message['message_id'])
+                    self.controller.update(None, sent_at)
+                    self.retry(message)
+                    continue
+                self.controller.update(response, sent_at)
+                if response.status_code >= 500:
+                    logger.warning("Got a %d from GCM for message %d",
+                                   response.status_code,
+                                   message['message_id'])
+                    self.retry(message)
+                    continue
+                try:
+                    with profiler.phase('handle_response'):
+                        self.handle_response(message, response)
+                except Exception:
+                    logger.exception("While handling GCM response to "
+                                     "message %d", message['message_id'])
+        if self.metrics.log():
+            self.controller.log()
 
-    def exponential_backoff(self, response):
-        """Parses the backoff duration GCM asks us to wait,
-        Backoff exponentially if GCM returns error code in the 500 range.
+    def retry(self, message):
+        """Queue a failed batch again, or drop it after MAX_FAILURES.
         """
-        retry_after = response.headers.get('Retry-After', None)
-        if retry_after is not None:
-            self.backoff = int(retry_after)
-        elif response == 200:
-            self.backoff = 0
-        elif response.status_code >= 500:
-            self.backoff = 1 if self.backoff == 0 else self.backoff * 2
-            logger.info("Will backoff %d seconds after receiving a %d error",
-                        self.backoff, response.status_code)
+        message['failures'] = message.get('failures', 0) + 1
+        if message['failures'] >= MAX_FAILURES:
+            logger.error("Dropping a batch of %d registration_ids of "
+                         "message %d after %d failures",
+                         len(message['registration_ids']),
+                         message['message_id'], message['failures'])
+            return
+        self.queue.retry(message)
 
     def handle_result(self, message_id, registration_id, result):
         """Directly implemented from the documentation, which is presented
@@ -139,43 +431,62 @@ class GCMPusher(object):
                                     registration_id)
 
     def push_one(self, message):
-        """Push the given message to GCM servers.
+        """Push the given message to GCM servers, return the response.
+        Called from the thread pool, so must not touch MySQL.
         A message is a dict containing:
          - message_id
-         - registration_ids
+         - registration_ids, at most GCM_MAX_REGISTRATION_IDS of them
          - message
          - An optional collapse_key
          - boolean delay_while_idle
+         - priority
+         - ctime, as a unix timestamp, may be None for old messages
+        Encoding the part shared by all batches of a message once, and
+        splicing it in each body, was measured (see bench_payload.py)
+        and dropped: the registration_ids dominate the body, it was no
+        faster than a single dumps.
         """
         data = {'registration_ids': message['registration_ids'],
                 'data': {'msg': message['message']}}
         if message['collapse_key'] is not None:
             data['collapse_key'] = message['collapse_key']
         data['delay_while_idle'] = bool(message['delay_while_idle'])
-        data = json.dumps(data)
-        logger.debug("Will send %s", data)
-        try:
-            response = requests.post(self.url, data=data, headers=self.headers)
-            self.exponential_backoff(response)
-        except Exception:
-            logger.exception("While sending a message to GCM")
-        else:
-            parsed_response = response.json()
-            self.db.message.update({'multicast_id':
-                                    parsed_response['multicast_id']},
-                                   message_id=message['message_id'])
-            logger.info("Raw response from GCM: %s", response.content)
-            # If the value of failure and canonical_ids is 0, it's not
-            # necessary to parse the remainder of the
-            # response.
-            if ((parsed_response['failure'] > 0 or
-                 parsed_response['canonical_ids'] > 0)):
-                # Otherwise, we recommend that you iterate
-                # through the results field and do the following for each
-                # object in that list:
-                for i, result in enumerate(parsed_response['results']):
-                    self.handle_result(message['message_id'],
-                                       message['registration_ids'][i], result)
+        data = dumps(data)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Will send %s", data.decode('utf-8'))
+        with profiler.phase('push_one'):
+            return requests.post(self.url, data=data, headers=self.headers,
+                                 timeout=self.timeout)
+
+    def handle_response(self, message, response):
+        """Parse the GCM response to the given message.
+        """
+        if response.status_code != 200:
+            logger.error("Got a %d from GCM for message %d: %s",
+                         response.status_code, message['message_id'],
+                         response.content)
+            return
+        parsed_response = response.json()
+        if message['ctime'] is not None:
+            self.metrics.record(message['priority'],
+                                time() - float(message['ctime']))
+        # A message sent in several batches gets a multicast_id per
+        # batch, only the last one is kept.
+        self.db.message.update({'multicast_id':
+                                parsed_response['multicast_id']},
+                               message_id=message['message_id'])
+        logger.info("Raw response from GCM: %s", response.content)
+        # If the value of failure and canonical_ids is 0, it's not
+        # necessary to parse the remainder of the
+        # response.
+        if ((parsed_response['failure'] > 0 or
+             parsed_response['canonical_ids'] > 0)):
+            # Otherwise, we recommend that you iterate
+            # through the results field and do the following for each
+            # object in that list:
+            for i, result in enumerate(parsed_response['results']):
+                self.handle_result(message['message_id'],
+                                   message['registration_ids'][i], result)
 
 
 def parse_args():
@@ -192,10 +503,23 @@ def parse_args():
                         action='store_const',
                         const=logging.DEBUG,
                         help='Log debug messages')
+    parser.add_argument('--max-concurrency',
+                        default=16, type=int,
+                        help='Maximum number of requests in flight to GCM')
+    parser.add_argument('--max-rate',
+                        default=100, type=float,
+                        help='Maximum number of requests per second to GCM')
+    parser.add_argument('--profile-duration',
+                        default=30, type=int,
+                        help='Seconds to profile for, on SIGUSR2')
+    parser.add_argument('--profile-dir',
+                        default=profiler.directory,
+                        help='Where to write profiles')
     return parser.parse_args()
 
 
-def main(log_level=logging.INFO, syslog=False):
+def main(log_level=logging.INFO, syslog=False, max_concurrency=16,
+         max_rate=100, profile_duration=30, profile_dir=profiler.directory):
     """Called with command line arguments.
     """
     from logging import handlers
@@ -206,9 +530,16 @@ def main(log_level=logging.INFO, syslog=False):
     logging.getLogger('gcm').addHandler(
         logging.StreamHandler())
     logging.getLogger('gcm').setLevel(logging.DEBUG)
+    logging.getLogger('profiling').addHandler(
+        logging.StreamHandler())
+    logging.getLogger('profiling').setLevel(logging.INFO)
+    profiler.name = 'gcm_pusher'
+    profiler.directory = profile_dir
+    profiler.install_signal(profile_duration)
     gcm_backend = GCMBackend()
     gcm_backend.db.mysql_schema_update()
-    GCMPusher(gcm_backend, config['api_key']).run()
+    GCMPusher(gcm_backend, config['api_key'],
+              max_concurrency=max_concurrency, max_rate=max_rate).run()
 
 if __name__ == '__main__':
     main(**vars(parse_args()))
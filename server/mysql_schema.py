@@ -110,5 +110,9 @@ ALTER TABLE message ADD COLUMN channel_id INT UNSIGNED NOT NULL DEFAULT 0;
 """,
                 """
 ALTER TABLE message ADD COLUMN ctime DATETIME NULL;
+""",
+                """
+ALTER TABLE message ADD COLUMN priority TINYINT UNSIGNED NOT NULL DEFAULT 0
+    COMMENT "From 0 (bulk) to 9 (urgent), see gcm_pusher.WeightedFairQueue";
 """
                 ]
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""Runtime profiling, for a chosen window, without restarting the process.
+
+While a window is open, a thread samples the stacks of every other
+thread, and the phases wrapped in profiler.phase() are timed. When the
+window closes, both are dumped in a directory:
+ - NAME-PID-DATE-N.folded: sampled stacks in the "folded" format of
+   flamegraph.pl, speedscope, ...
+ - NAME-PID-DATE-N.phases: count, total, average and max time per phase.
+N being the number of the window in this process.
+"""
+
+import logging
+import os
+import signal
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from tempfile import gettempdir
+from time import localtime, sleep, strftime, time
+
+logger = logging.getLogger(__name__)
+
+
+class Window(object):
+    """What is collected during a profiling window.
+    """
+
+    def __init__(self, number, duration):
+        self.number = number
+        self.start = time()
+        self.until = self.start + duration
+        self.stacks = Counter()
+        self.phases = {}
+
+    @property
+    def active(self):
+        return time() < self.until
+
+
+class Profiler(object):
+    """Sampling profiler and phase timer, idle until started.
+    """
+
+    def __init__(self, name='kisspush', directory=gettempdir(),
+                 interval=.005):
+        self.name = name
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.window = None
+        self.windows = 0
+
+    @property
+    def active(self):
+        window = self.window
+        return window is not None and window.active
+
+    def start(self, duration=30):
+        """Open a profiling window of duration seconds.
+        Returns False if a window is already open.
+        """
+        with self.lock:
+            if self.active:
+                return False
+            self.windows += 1
+            window = self.window = Window(self.windows, duration)
+        logger.info("Profiling for %d seconds", duration)
+        threading.Thread(target=self.sample, args=(window,),
+                         name='profiler', daemon=True).start()
+        return True
+
+    def install_signal(self, duration=30, signum=signal.SIGUSR2):
+        """Open a profiling window of duration seconds on signum.
+        The handler only sets an event, a thread does the start, as
+        the interrupted thread may hold any lock start needs.
+        """
+        requested = threading.Event()
+
+        def starter():
+            while True:
+                requested.wait()
+                requested.clear()
+                self.start(duration)
+        threading.Thread(target=starter, name='profiler-signal',
+                         daemon=True).start()
+        signal.signal(signum, lambda signum, frame: requested.set())
+
+    @contextmanager
+    def phase(self, name):
+        """Time the wrapped block as the given phase, if profiling.
+        """
+        window = self.window
+        if window is None or not window.active:
+            yield
+            return
+        start = time()
+        try:
+            yield
+        finally:
+            self.record(window, name, time() - start)
+
+    def record(self, window, name, duration):
+        with self.lock:
+            phase = window.phases.setdefault(name, {'calls': 0,
+                                                    'total': 0.0,
+                                                    'max': 0.0})
+            phase['calls'] += 1
+            phase['total'] += duration
+            phase['max'] = max(phase['max'], duration)
+
+    def sample(self, window):
+        """Sample the stacks of all other threads until the window
+        closes, then dump it.
+        """
+        me = threading.get_ident()
+        while window.active:
+            names = {thread.ident: thread.name
+                     for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                window.stacks[';'.join(reversed(stack))] += 1
+            sleep(self.interval)
+        self.dump(window)
+
+    def dump(self, window):
+        path = os.path.join(self.directory, '%s-%d-%s-%d' % (
+            self.name, os.getpid(),
+            strftime('%Y%m%d-%H%M%S', localtime(window.start)),
+            window.number))
+        with self.lock:
+            phases = dict(window.phases)
+        with open(path + '.folded', 'w') as folded:
+            for stack, count in window.stacks.most_common():
+                folded.write('%s %d\n' % (stack, count))
+        with open(path + '.phases', 'w') as timings:
+            for name, phase in sorted(phases.items()):
+                line = ("%s: %d calls, %.3fs total, %.2fms avg, "
+                        "%.2fms max" % (
+                            name, phase['calls'], phase['total'],
+                            1000 * phase['total'] / phase['calls'],
+                            1000 * phase['max']))
+                logger.info(line)
+                timings.write(line + '\n')
+        logger.info("Profile written to %s.folded and %s.phases", path, path)
+
+
+profiler = Profiler()